@@ -3,109 +3,324 @@ import json
 import uuid
 import time
 import threading
+import queue
 import webbrowser
 import logging
 import re
+import codecs
+import hashlib
+import gzip
+from collections import OrderedDict, deque
 from flask import Flask, request, jsonify, Response, stream_with_context
 
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+WHI_GRAMMAR = r'''
+root ::= "{" ws "\"complex\":" ws ("\"NO\"" | "\"YES\"" ws "," ws plan) ws "}"
+plan ::= "\"goal\":" ws str "," ws "\"steps\":" ws str "," ws "\"single\":" ws ("\"YES\"" | "\"NO\"" ws "," ws "\"subtasks\":" ws list)
+list ::= "[" ws str (ws "," ws str)* ws "]"
+str ::= "\"" ([^"\\\n] | "\\" ["\\/bfnrt])* "\""
+ws ::= " "?
+'''
+TEMPLATES = {
+    "whi": "Task: Say whether this is a complex task requiring a plan (YES or NO). If YES, identify the specific goal, list brief steps to achieve it, and say whether it is a single step task (YES or NO); if not single, also list the sub-tasks. Answer in JSON.",
+    "exec": "Task: Write the response now.",
+}
+BAD_RE = re.compile(r'SYSTEM:|GLOBAL CONTEXT:|Instruction:|Context:|Response:')
+QUOTES = str.maketrans("", "", "`'\"")
+JSON_DECODER = json.JSONDecoder()
+JSON_ENCODE = json.JSONEncoder(separators=(',', ':'), ensure_ascii=False).encode
+MAX_SESSIONS = 256
+MAX_STATES = 3
+PLAN_WORDS_RE = re.compile(r'\b(and|then|plan|steps|multiple)\b', re.I)
+QUANT_RANK = ["Q4_K_M", "Q5_K_M", "Q4_K_S", "Q5_K_S", "Q6_K", "Q8_0"]
+
+def msg(t, c, tgt=None):
+    if orjson: return orjson.dumps({"type": t, "content": c, "target": tgt}, option=orjson.OPT_APPEND_NEWLINE)
+    return (JSON_ENCODE({"type": t, "content": c, "target": tgt}) + "\n").encode()
+
+def token_msg(txt):
+    return b'{"type":"token","content":' + (orjson.dumps(txt) if orjson else JSON_ENCODE(txt).encode()) + b',"target":null}\n'
+
 app = Flask(__name__)
 log = logging.getLogger('werkzeug')
 log.setLevel(logging.ERROR)
 
+class PromptBuffer:
+    def __init__(self, limit=4000):
+        self.parts = deque()
+        self.size = 0
+        self.limit = limit
+        self.joined = ""
+
+    @property
+    def text(self):
+        if self.joined is None: self.joined = "".join(self.parts)
+        return self.joined
+
+    def append(self, part):
+        self.parts.append(part)
+        self.size += len(part)
+        self.joined = None
+        if self.size > self.limit:
+            while len(self.parts) > 1 and self.size > self.limit // 2:
+                self.size -= len(self.parts.popleft())
+            if self.size > self.limit:
+                self.parts[0] = self.parts[0][-(self.limit // 2):]
+                self.size = len(self.parts[0])
+
 class CoreEngine:
     def __init__(self):
         self.model = None
-        self.sessions = {}
-        self.lock = threading.Lock()
+        self.loaded = None
+        self.whi_grammar = None
+        self.tok_head = []
+        self.tok_tail = []
+        self.tok_nl = None
+        self.vocab = None
+        self.tok_templates = {}
+        self.sessions = OrderedDict()
+        self.sessions_lock = threading.RLock()
+        self.sessions_index = None
+        self.use_lock = threading.RLock()
+        self.load_lock = threading.Lock()
+        self.active = None
+        self.states = OrderedDict()
+        self.router_cache = OrderedDict()
         self.config = {
             "n_gpu_layers": -1,
             "n_ctx": 8192,
-            "n_threads": 4,
-            "n_batch": 512
+            "n_threads": max(min(os.cpu_count() or 4, 16) // 2, 1),
+            "n_threads_batch": min(os.cpu_count() or 4, 16),
+            "n_batch": 2048,
+            "n_ubatch": 512,
+            "prompt_cache_mb": 0
         }
+        self.jobs = queue.Queue()
+        threading.Thread(target=self.run_jobs, daemon=True).start()
         self.has_llama = False
         try:
             from llama_cpp import Llama
             self.has_llama = True
         except: pass
 
+    def submit(self, job):
+        out, cancel = queue.Queue(), threading.Event()
+        self.jobs.put((job, out, cancel))
+        try:
+            while True:
+                item = out.get()
+                if item is None: return
+                yield item
+        finally:
+            cancel.set()
+
+    def run_jobs(self):
+        # Strictly one job at a time: llama-cpp-python's Llama owns a single-sequence context, so
+        # interleaving requests could not share a decode step and would only evict each other's KV
+        while True:
+            job, out, cancel = self.jobs.get()
+            try:
+                for item in job:
+                    if cancel.is_set(): break
+                    out.put(item)
+            except Exception:
+                logging.exception("Pipeline failed")
+            finally:
+                job.close()
+                out.put(None)
+
     def update_config(self, cfg):
-        self.config.update(cfg)
+        with self.load_lock:
+            changed = {k for k, v in cfg.items() if str(self.config.get(k)) != str(v)}
+            self.config.update(cfg)
+            if not self.model or not changed: return False
+            if not changed <= {"n_threads", "n_threads_batch"}: return True
+            # Only the thread fields change on the live context; a reload still pending for other settings stays pending
+            self.loaded = self.loaded[:3] + (int(self.config["n_threads"]), int(self.config["n_threads_batch"])) + self.loaded[5:]
+            pending = self.loaded != self.load_key(self.loaded[0])
+        # The worker applies it between pipelines, never during a decode; this request does not wait for it
+        self.jobs.put((self.set_threads(), queue.Queue(), threading.Event()))
+        return pending
+
+    def set_threads(self):
+        with self.use_lock:
+            if self.model:
+                import llama_cpp
+                llama_cpp.llama_set_n_threads(self.model.ctx, int(self.config["n_threads"]), int(self.config["n_threads_batch"]))
+        yield from ()
+
+    def load_key(self, path):
+        return (path,) + tuple(int(self.config[k]) for k in ("n_gpu_layers", "n_ctx", "n_threads", "n_threads_batch", "n_batch", "n_ubatch", "prompt_cache_mb"))
 
     def load_model(self, path):
         if not self.has_llama: return False
-        with self.lock:
+        with self.load_lock:
+            key = self.load_key(path)
+            if self.model and self.loaded == key: return True
+            return self.reload(path, key)
+
+    def reload(self, path, key):
+        with self.use_lock:
             if self.model: del self.model
+            self.active = None
+            self.router_cache.clear()
+            self.states.clear()
             from llama_cpp import Llama
             self.model = Llama(
                 model_path=path,
                 n_gpu_layers=int(self.config["n_gpu_layers"]),
                 n_ctx=int(self.config["n_ctx"]),
                 n_threads=int(self.config["n_threads"]),
+                n_threads_batch=int(self.config["n_threads_batch"]),
                 n_batch=int(self.config["n_batch"]),
+                n_ubatch=int(self.config["n_ubatch"]),
+                use_mmap=True,
+                use_mlock=False,
                 verbose=False
             )
+            from llama_cpp import LlamaGrammar
+            self.loaded = key
+            if int(self.config["prompt_cache_mb"]) > 0:
+                from llama_cpp import LlamaRAMCache
+                self.model.set_cache(LlamaRAMCache(capacity_bytes=int(self.config["prompt_cache_mb"]) << 20))
+            self.whi_grammar = LlamaGrammar.from_string(WHI_GRAMMAR, verbose=False)
+            self.tok_head = self.model.tokenize(b"### Instruction:\n")
+            # SPM vocabularies put a space in front of every separately tokenized piece; mid-prompt pieces must not get it
+            nl = self.model.tokenize(b"\n", add_bos=False)
+            self.tok_nl = nl if self.model.detokenize(nl) != b"\n" else None
+            import llama_cpp
+            self.vocab = llama_cpp.llama_model_get_vocab(self.model.model) if hasattr(llama_cpp, "llama_model_get_vocab") else self.model.model
+            self.tok_tail = self.tokens("\n\n### Response:\n")
+            self.tok_templates = {k: self.tokens(v) for k, v in TEMPLATES.items()}
+            self.model.create_completion(prompt=self.tok_head, max_tokens=1, temperature=0)
         return True
 
     def create_session(self, title="New Operation"):
         uid = str(uuid.uuid4())
-        self.sessions[uid] = {
-            "id": uid,
-            "title": title,
-            "history": [],
-            "created": time.time()
-        }
+        with self.sessions_lock:
+            self.sessions[uid] = {
+                "id": uid,
+                "title": title,
+                "context": PromptBuffer()
+            }
+            while len(self.sessions) > MAX_SESSIONS: self.sessions.popitem(last=False)
+            self.sessions_index = None
         return uid
 
     def get_session(self, uid):
-        return self.sessions.get(uid)
-
-    def list_sessions(self):
-        return sorted(self.sessions.values(), key=lambda x: x['created'], reverse=True)
+        with self.sessions_lock:
+            sess = self.sessions.get(uid)
+            if sess and next(reversed(self.sessions)) != uid:
+                self.sessions.move_to_end(uid)
+                self.sessions_index = None
+            return sess
+
+    def session_index(self):
+        with self.sessions_lock:
+            if self.sessions_index is None:
+                index = [{'id': s['id'], 'title': s['title']} for s in reversed(self.sessions.values())]
+                self.sessions_index = orjson.dumps(index) if orjson else JSON_ENCODE(index).encode()
+            return self.sessions_index
 
     def delete_session(self, uid):
-        if uid in self.sessions: del self.sessions[uid]
-
-    def inference(self, prompt, temp=0.1, max_tokens=2048, stop=None):
+        with self.sessions_lock:
+            if uid in self.sessions:
+                del self.sessions[uid]
+                self.sessions_index = None
+
+    def restore_session(self, sess):
+        # Snapshot the outgoing session only when another one takes the context: save_state() copies the KV and logits
+        with self.use_lock:
+            if not self.model or self.active == sess['id']: return
+            if self.active in self.sessions:
+                self.states[self.active] = self.model.save_state()
+                while len(self.states) > MAX_STATES: self.states.popitem(last=False)
+            state = self.states.pop(sess['id'], None)
+            if state: self.model.load_state(state)
+            self.active = sess['id']
+
+    def cached_route(self, task, chat_check=True):
+        if chat_check and len(task) < 40 and task.count('.') <= 1 and not PLAN_WORDS_RE.search(task): return False
+        key = hashlib.blake2b(task.encode("utf-8"), digest_size=16).digest()
+        with self.use_lock:
+            if key not in self.router_cache: return None
+            self.router_cache.move_to_end(key)
+            return self.router_cache[key]
+
+    def remember_route(self, task, is_complex):
+        key = hashlib.blake2b(task.encode("utf-8"), digest_size=16).digest()
+        with self.use_lock:
+            self.router_cache[key] = is_complex
+            if len(self.router_cache) > 256: self.router_cache.popitem(last=False)
+
+    def tokens(self, text):
+        if not text or not self.model: return []
+        if not self.tok_nl: return self.model.tokenize(text.encode("utf-8"), add_bos=False)
+        toks = self.model.tokenize(b"\n" + text.encode("utf-8"), add_bos=False)
+        n = len(self.tok_nl)
+        return toks[n:] if toks[:n] == self.tok_nl else self.model.tokenize(text.encode("utf-8"), add_bos=False)
+
+    def prompt_tokens(self, prompt, prefix="", template=None):
+        if isinstance(prefix, str): return self.tok_head + self.tokens(f"{prefix}{prompt}") + self.tok_templates.get(template, []) + self.tok_tail
+        return self.tok_head + prefix + self.tokens(prompt) + self.tok_templates.get(template, []) + self.tok_tail
+
+    def inference(self, prompt, temp=0.1, max_tokens=2048, stop=None, prefix="", grammar=None, template=None):
         if not self.model: return None
-        with self.lock:
-            full_prompt = f"### Instruction:\n{prompt}\n\n### Response:\n"
+        with self.use_lock:
             return self.model.create_completion(
-                prompt=full_prompt,
+                prompt=self.prompt_tokens(prompt, prefix, template),
                 temperature=temp,
                 max_tokens=max_tokens,
                 stop=stop or ["###", "User:", "\n\n"],
+                grammar=grammar,
                 echo=False
             )
 
+    def stream(self, prompt, temp=0.7, max_tokens=2048, prefix="", template=None, batch=8):
+        with self.use_lock:
+            tokens = self.prompt_tokens(prompt, prefix, template)
+            import llama_cpp
+            decoder = codecs.getincrementaldecoder("utf-8")(errors="ignore")
+            pending, held = [], ""
+            for n, tok in enumerate(self.model.generate(tokens, temp=temp)):
+                if llama_cpp.llama_token_is_eog(self.vocab, tok) or n >= max_tokens: break
+                pending.append(tok)
+                if len(pending) < batch: continue
+                text = held + decoder.decode(self.model.detokenize(pending))
+                pending = []
+                if "###" in text:
+                    text = text[:text.index("###")]
+                    if text: yield text
+                    return
+                # Hold back a trailing partial marker; only this carry plus the new chunk is ever scanned
+                keep = min(len(text) - len(text.rstrip("#")), 2)
+                held = text[len(text) - keep:]
+                if len(text) > keep: yield text[:len(text) - keep]
+            text = (held + decoder.decode(self.model.detokenize(pending), final=True)).split("###")[0]
+            if text: yield text
+
 ENGINE = CoreEngine()
 
 def process_pipeline(original_prompt, session_id, settings):
     sess = ENGINE.get_session(session_id)
     if not sess: return
 
-    def msg(t, c, tgt=None):
-        return json.dumps({"type": t, "content": c, "target": tgt}) + "\n"
-        
     def clean_resp(text):
         if not text: return ""
-        text = text.replace("`", "").replace("'", "").replace('"', "")
-        bad = ["SYSTEM:", "GLOBAL CONTEXT:", "Instruction:", "Context:", "Response:"]
-        for b in bad:
-            text = text.replace(b, "")
-        return text.strip()
+        return BAD_RE.sub("", text.translate(QUOTES)).strip()
 
-    def prune_context(ctx, limit=4000):
-        if len(ctx) > limit: return "...(truncated)\n" + ctx[-(limit):]
-        return ctx
+    def first_json(text):
+        start = text.find("{")
+        if start < 0: raise ValueError("no JSON object")
+        return JSON_DECODER.raw_decode(text, start)[0]
 
     yield msg("status", "Initializing WHIS-ReAct Protocol...")
     
-    global_context = "" 
-    if sess['history']:
-        global_context += "Prior Chat History:\n"
-        for m in sess['history'][-6:]:
-            global_context += f"{'User' if m['role']=='user' else 'AI'}: {m['content']}\n"
+    ctx = sess['context']
             
     task_stack = [{"depth": 1, "task": original_prompt, "type": "MAIN"}]
     MAX_DEPTH = 3 
@@ -122,94 +337,97 @@ def process_pipeline(original_prompt, session_id, settings):
             yield msg("card", f"Sub-tasks completed for: {task}", f"{prefix} Context")
             continue
 
-        yield msg("status", f"{prefix} WHI Analysis...")
-
-        p_router = f"Input: {task}\nQuestion: Is this a complex task requiring a plan? Answer YES or NO."
-        res_router = ENGINE.inference(p_router, temp=0.1, max_tokens=10, stop=["\n"])
-        is_complex = "YES" in res_router['choices'][0]['text'].upper() if res_router else True
-
-        if not is_complex:
-            val_w = "Chat with user"
-            yield msg("card", f"W: {val_w}", f"{prefix} WHI")
-            
-            val_h = "Reply naturally"
-            yield msg("card", f"H: {val_h}", f"{prefix} WHI")
+        with ENGINE.use_lock:
+            ENGINE.restore_session(sess)
+            yield msg("status", f"{prefix} WHI Analysis...")
+
+            common = ENGINE.tokens(f"Context: {ctx.text}\nInput: {task}\n")
+
+            if depth == MAX_DEPTH:
+                is_complex = True
+            else:
+                # Sub-tasks are short imperative phrases, so the chat heuristic only applies to the user's prompt
+                is_complex = ENGINE.cached_route(task, item['type'] == 'MAIN')
+                if is_complex is not False:
+                    res_whi = ENGINE.inference("", temp=0.1, max_tokens=512, stop=["###"], prefix=common, grammar=ENGINE.whi_grammar, template="whi")
+                    try:
+                        whi = first_json(res_whi['choices'][0]['text'])
+                        is_complex = whi["complex"] == "YES"
+                        ENGINE.remember_route(task, is_complex)
+                    except:
+                        whi, is_complex = {}, True
+
+            if not is_complex:
+                val_w = "Chat with user"
+                yield msg("card", f"W: {val_w}", f"{prefix} WHI")
             
-            val_i = "YES"
-            yield msg("card", f"I: {val_i}", f"{prefix} WHI")
-        else:
-            p_what = f"Input: {task}\nContext: {prune_context(global_context)}\nTask: Identify the specific goal."
-            res_w = ENGINE.inference(p_what, temp=0.1, max_tokens=64, stop=["\n\n", "###"])
-            val_w = clean_resp(res_w['choices'][0]['text']) if res_w else ""
+                val_h = "Reply naturally"
+                yield msg("card", f"H: {val_h}", f"{prefix} WHI")
             
-            if not val_w or "sorry" in val_w.lower() or "understand" in val_w.lower(): 
-                val_w = "Execute task"
+                val_i = "YES"
+                yield msg("card", f"I: {val_i}", f"{prefix} WHI")
+            elif depth < MAX_DEPTH:
+                val_w = clean_resp(whi.get("goal", ""))
+                if not val_w or "sorry" in val_w.lower() or "understand" in val_w.lower(): 
+                    val_w = "Execute task"
+                yield msg("card", f"W: {val_w}", f"{prefix} WHI")
 
-            yield msg("card", f"W: {val_w}", f"{prefix} WHI")
+                val_h = clean_resp(whi.get("steps", "")) or "Execute immediately"
+                yield msg("card", f"H: {val_h}", f"{prefix} WHI")
 
-            p_how = f"Input: {task}\nGoal: {val_w}\nTask: List brief steps to achieve this."
-            res_h = ENGINE.inference(p_how, temp=0.1, max_tokens=128, stop=["\n\n", "###"])
-            val_h = clean_resp(res_h['choices'][0]['text']) if res_h else ""
-            
-            if not val_h: val_h = "Execute immediately"
+                val_i = "NO" if whi.get("single") == "NO" and whi.get("subtasks") else "YES"
+                yield msg("card", f"I: {val_i}", f"{prefix} WHI")
+            else:
+                val_w = task
+                yield msg("card", f"W: {val_w}", f"{prefix} WHI")
 
-            yield msg("card", f"H: {val_h}", f"{prefix} WHI")
+                val_h = "Execute as leaf"
+                yield msg("card", f"H: {val_h}", f"{prefix} WHI")
 
-            val_i = "YES"
-            if depth < MAX_DEPTH:
-                p_is = f"Steps: {val_h}\nQuestion: Is this a single step task? YES or NO."
-                res_i = ENGINE.inference(p_is, temp=0.1, max_tokens=10)
-                if res_i and "NO" in res_i['choices'][0]['text'].upper(): val_i = "NO"
-            
-            yield msg("card", f"I: {val_i}", f"{prefix} WHI")
+                val_i = "YES"
+                yield msg("card", f"I: {val_i}", f"{prefix} WHI")
 
-        if val_i == "NO":
-            yield msg("status", f"{prefix} Status: COMPLEX. Splitting...")
-            
-            p_split = f"Goal: {val_w}\nSteps: {val_h}\nTask: Return a JSON list of sub-tasks. Example: [\"Step1\", \"Step2\"]"
-            res_split = ENGINE.inference(p_split, temp=0.1)
+            if val_i == "NO":
+                yield msg("status", f"{prefix} Status: COMPLEX. Splitting...")
             
-            try:
-                txt = res_split['choices'][0]['text']
-                match = re.search(r'\[.*\]', txt, re.DOTALL)
-                if match:
-                    sub_tasks = json.loads(match.group())
-                    task_stack.append({"depth": depth, "task": task, "type": "RESUME"})
-                    for st in reversed(sub_tasks):
-                        task_stack.append({"depth": depth + 1, "task": st, "type": "SUB"})
-                    yield msg("card", "\n".join(sub_tasks), f"{prefix} Split Plan")
-                    continue
-            except:
-                val_i = "YES"
+                sub_tasks = whi["subtasks"]
+                # Only leaves are written to the context below, so a split turn records the user's prompt here
+                if item['type'] == 'MAIN': ctx.append(f"User: {task}\n")
+                task_stack.append({"depth": depth, "task": task, "type": "RESUME"})
+                for st in reversed(sub_tasks):
+                    task_stack.append({"depth": depth + 1, "task": st, "type": "SUB"})
+                yield msg("card", "\n".join(sub_tasks), f"{prefix} Split Plan")
+                continue
                 
-        if val_i == "YES":
-            yield msg("status", f"{prefix} Status: CLEAR. Executing...")
+            if val_i == "YES":
+                yield msg("status", f"{prefix} Status: CLEAR. Executing...")
             
-            prompt_exec = f"Context: {prune_context(global_context)}\nRequest: {task}\nGoal: {val_w}\nPlan: {val_h}\n\nTask: Write the response now."
+                prompt_exec = f"Goal: {val_w}\nPlan: {val_h}\n\n"
             
-            with ENGINE.lock:
-                stream = ENGINE.model.create_completion(
-                    prompt=f"### Instruction:\n{prompt_exec}\n\n### Response:\n",
-                    max_tokens=2048,
-                    temperature=0.7, 
-                    stop=["###"],
-                    stream=True
-                )
-                
                 content_chunk = ""
                 try:
-                    for chunk in stream:
-                        txt = chunk['choices'][0]['text']
+                    for txt in ENGINE.stream(prompt_exec, temp=0.7, max_tokens=2048, prefix=common, template="exec"):
                         content_chunk += txt
-                        yield msg("token", txt)
+                        yield token_msg(txt)
                 except Exception as e:
-                    yield msg("token", f"\n[Error: {str(e)}]")
-            
-            global_context += f"\nUser: {task}\nAI: {content_chunk}\n"
+                    yield token_msg(f"\n[Error: {str(e)}]")
+        
+                ctx.append(f"User: {task}\nAI: {content_chunk}\n")
             
-    sess['history'].append({"role": "user", "content": original_prompt})
     yield msg("done", "Ready")
 
+def coalesce(events, limit=1490, idle=0.02):
+    buf = bytearray()
+    last = time.monotonic()
+    for ev in events:
+        buf += ev
+        now = time.monotonic()
+        if len(buf) >= limit or b'"token"' not in ev[:18] or now - last >= idle:
+            yield bytes(buf)
+            buf.clear()
+            last = now
+    if buf: yield bytes(buf)
+
 HTML_UI = r"""
 <!DOCTYPE html>
 <html lang="en">
@@ -269,6 +487,14 @@ select, input { width: 100%; background: #0f172a; border: 1px solid #334155; col
         <input type="number" id="hwGpu" value="-1" placeholder="GPU Layers">
         <div style="height:5px"></div>
         <input type="number" id="hwCtx" value="8192" placeholder="Context Size">
+        <div style="height:5px"></div>
+        <input type="number" id="hwThreads" value="4" placeholder="Decode Threads">
+        <div style="height:5px"></div>
+        <input type="number" id="hwThreadsBatch" value="8" placeholder="Prefill Threads">
+        <div style="height:5px"></div>
+        <input type="number" id="hwBatch" value="2048" placeholder="Batch Size">
+        <div style="height:5px"></div>
+        <input type="number" id="hwUbatch" value="512" placeholder="Micro-batch Size">
         <button class="btn" onclick="applyHardware()">Apply Config</button>
 
         <div class="lbl">SESSIONS</div>
@@ -302,6 +528,7 @@ let currentSessionId = null;
 
 window.onload = function() {
     scanForModels();
+    loadHardware();
     refreshSessionList();
 }
 
@@ -310,7 +537,18 @@ async function scanForModels() {
     const data = await res.json();
     const sel = document.getElementById('modelSelect');
     sel.innerHTML = "<option>Select Model...</option>";
-    data.forEach(m => sel.innerHTML += `<option value="${m.path}">${m.name}</option>`);
+    data.forEach(m => sel.innerHTML += `<option value="${m.path}">${m.name}${m.warn ? ' (unquantized, slow)' : ''}</option>`);
+}
+
+async function loadHardware() {
+    const res = await fetch('/config_hardware');
+    const cfg = await res.json();
+    document.getElementById('hwGpu').value = cfg.n_gpu_layers;
+    document.getElementById('hwCtx').value = cfg.n_ctx;
+    document.getElementById('hwThreads').value = cfg.n_threads;
+    document.getElementById('hwThreadsBatch').value = cfg.n_threads_batch;
+    document.getElementById('hwBatch').value = cfg.n_batch;
+    document.getElementById('hwUbatch').value = cfg.n_ubatch;
 }
 
 async function loadSelectedModel() {
@@ -326,15 +564,20 @@ async function loadSelectedModel() {
 }
 
 async function applyHardware() {
-    await fetch('/config_hardware', {
+    const res = await fetch('/config_hardware', {
         method: 'POST',
         headers: {'Content-Type': 'application/json'},
         body: JSON.stringify({
             n_gpu_layers: document.getElementById('hwGpu').value,
-            n_ctx: document.getElementById('hwCtx').value
+            n_ctx: document.getElementById('hwCtx').value,
+            n_threads: document.getElementById('hwThreads').value,
+            n_threads_batch: document.getElementById('hwThreadsBatch').value,
+            n_batch: document.getElementById('hwBatch').value,
+            n_ubatch: document.getElementById('hwUbatch').value
         })
     });
-    alert("Config Updated. Please reload model.");
+    const data = await res.json();
+    alert(data.reload ? "Config Updated. Please reload model." : "Config Updated.");
 }
 
 async function createNewChat() {
@@ -374,13 +617,33 @@ function appendMessage(role, text) {
     return div.querySelector('.content');
 }
 
+const MD_RE = /```(\w*)([\s\S]*?)```|\*\*(.*?)\*\*|[<>\n]/g;
+const escapeHtml = s => s.replace(/</g, "&lt;").replace(/>/g, "&gt;");
+
 function parseMarkdown(text) {
     if(!text) return "";
-    return text
-        .replace(/</g, "&lt;").replace(/>/g, "&gt;")
-        .replace(/```(\w*)([\s\S]*?)```/g, '<pre><code>$2</code></pre>')
-        .replace(/\*\*(.*?)\*\*/g, '<b>$1</b>')
-        .replace(/\n/g, '<br>');
+    return text.replace(MD_RE, (m, lang, code, bold) => {
+        if (code !== undefined) return `<pre><code>${escapeHtml(code)}</code></pre>`;
+        if (bold !== undefined) return `<b>${escapeHtml(bold)}</b>`;
+        return m === '<' ? '&lt;' : m === '>' ? '&gt;' : '<br>';
+    });
+}
+
+function splitLines() {
+    let tail = "";
+    return new TransformStream({
+        transform(chunk, controller) {
+            let start = 0, nl;
+            while ((nl = chunk.indexOf("\n", start)) !== -1) {
+                const line = tail + chunk.slice(start, nl);
+                tail = "";
+                start = nl + 1;
+                if (line) controller.enqueue(line);
+            }
+            tail += chunk.slice(start);
+        },
+        flush(controller) { if (tail) controller.enqueue(tail); }
+    });
 }
 
 async function runPipeline() {
@@ -394,6 +657,13 @@ async function runPipeline() {
     appendMessage('user', text);
     const aiBubble = appendMessage('ai', '');
     let fullText = "";
+    let rendered = 0;
+    let framePending = false;
+    const render = () => {
+        framePending = false;
+        rendered = fullText.length;
+        aiBubble.innerHTML = parseMarkdown(fullText);
+    };
 
     const res = await fetch('/stream', {
         method: 'POST',
@@ -401,24 +671,19 @@ async function runPipeline() {
         body: JSON.stringify({prompt: text, id: currentSessionId, settings: {}})
     });
 
-    const reader = res.body.getReader();
-    const decoder = new TextDecoder();
-    let buffer = "";
-
-    while (true) {
-        const {done, value} = await reader.read();
-        if (done) break;
-        buffer += decoder.decode(value, {stream: true});
-        const lines = buffer.split("\n"); 
-        buffer = lines.pop();
-
-        for (const line of lines) {
-            if (!line) continue;
+    await res.body
+        .pipeThrough(new TextDecoderStream())
+        .pipeThrough(splitLines())
+        .pipeTo(new WritableStream({write(line) {
             try {
                 const data = JSON.parse(line);
                 if (data.type === 'token') {
                     fullText += data.content;
-                    aiBubble.innerHTML = parseMarkdown(fullText);
+                    aiBubble.appendChild(document.createTextNode(data.content));
+                    if (!framePending && (fullText.length - rendered >= 16 || data.content.includes('```'))) {
+                        framePending = true;
+                        requestAnimationFrame(render);
+                    }
                 } else if (data.type === 'card') {
                     const c = document.createElement('div');
                     c.className = 'card';
@@ -427,32 +692,50 @@ async function runPipeline() {
                 }
                 document.getElementById('chatContainer').scrollTo(0, 99999);
             } catch (e) {}
-        }
-    }
+        }}));
+    render();
 }
 </script>
 </body>
 </html>
 """
 
+HTML_BYTES = HTML_UI.encode('utf-8')
+HTML_GZ = gzip.compress(HTML_BYTES, compresslevel=9, mtime=0)
+HTML_ETAG = 'W/"' + hashlib.md5(HTML_BYTES).hexdigest() + '"'
+
 @app.route('/')
-def index(): return HTML_UI
+def index():
+    headers = {'ETag': HTML_ETAG, 'Cache-Control': 'public, max-age=3600', 'Vary': 'Accept-Encoding'}
+    if request.headers.get('If-None-Match') == HTML_ETAG: return Response(status=304, headers=headers)
+    if 'gzip' not in request.headers.get('Accept-Encoding', ''): return Response(HTML_BYTES, mimetype='text/html', headers=headers)
+    headers['Content-Encoding'] = 'gzip'
+    return Response(HTML_GZ, mimetype='text/html', headers=headers)
+
+SCAN_CACHE = {"mtime": None, "json": b"[]"}
 
 @app.route('/scan')
 def scan():
+    cwd = os.getcwd()
+    try: mtime = (cwd, os.stat(cwd).st_mtime_ns)
+    except OSError: mtime = None
+    if mtime and SCAN_CACHE["mtime"] == mtime: return Response(SCAN_CACHE["json"], mimetype='application/json')
     m = []
     try:
-        files = os.listdir('.')
-        for n in files:
-            if n.endswith('.gguf'):
-                m.append({'name': n, 'path': os.path.join(os.getcwd(), n)})
+        with os.scandir(cwd) as it:
+            for e in it:
+                if e.name.endswith('.gguf'):
+                    up = e.name.upper()
+                    m.append({'name': e.name, 'path': e.path, 'warn': 'F16' in up or 'F32' in up})
     except: pass
-    return jsonify(m)
+    m.sort(key=lambda x: (next((i for i, q in enumerate(QUANT_RANK) if q in x['name'].upper()), len(QUANT_RANK)), x['name']))
+    SCAN_CACHE.update(mtime=mtime, json=orjson.dumps(m) if orjson else JSON_ENCODE(m).encode())
+    return Response(SCAN_CACHE["json"], mimetype='application/json')
 
-@app.route('/config_hardware', methods=['POST'])
+@app.route('/config_hardware', methods=['GET', 'POST'])
 def config_hw():
-    ENGINE.update_config(request.json)
-    return jsonify({'ok': True})
+    if request.method == 'GET': return jsonify(ENGINE.config)
+    return jsonify({'ok': True, 'reload': ENGINE.update_config(request.json)})
 
 @app.route('/load_model', methods=['POST'])
 def load_model():
@@ -461,7 +744,7 @@ def load_model():
 
 @app.route('/list_sessions')
 def list_sessions():
-    return jsonify([{'id': s['id'], 'title': s['title']} for s in ENGINE.list_sessions()])
+    return Response(ENGINE.session_index(), mimetype='application/json')
 
 @app.route('/create_session', methods=['POST'])
 def create_session():
@@ -471,10 +754,20 @@ def create_session():
 def stream():
     d = request.json
     return Response(
-        stream_with_context(process_pipeline(d['prompt'], d['id'], d['settings'])),
-        mimetype='application/x-ndjson'
+        stream_with_context(coalesce(ENGINE.submit(process_pipeline(d['prompt'], d['id'], d['settings'])))),
+        mimetype='application/x-ndjson',
+        direct_passthrough=True
     )
 
 if __name__ == '__main__':
-    threading.Timer(1.5, lambda: webbrowser.open("http://127.0.0.1:5000")).start()
-    app.run(port=5000, debug=False, use_reloader=False, threaded=True)
+    try:
+        from waitress import create_server
+        server = create_server(app, host="127.0.0.1", port=5000, threads=8, channel_timeout=600)
+        serve = server.run
+    except ImportError:
+        from werkzeug.serving import make_server
+        server = make_server("127.0.0.1", 5000, app, threaded=True)
+        serve = server.serve_forever
+    # Console browsers wait on their child process, so the page is opened off the serving thread
+    if os.environ.get("OPEN_BROWSER") == "1": threading.Thread(target=webbrowser.open, args=("http://127.0.0.1:5000",), daemon=True).start()
+    serve()